@@ -1,8 +1,9 @@
 import os
-import subprocess
 import logging
-import tempfile
-import shutil
+import functools
+from concurrent.futures import ProcessPoolExecutor
+
+from JpegUtils import fill_template, write_injected_jpeg
 
 logging.basicConfig(
     level=logging.INFO,
@@ -10,8 +11,7 @@ logging.basicConfig(
 )
 
 
-def create_xmp_file(image_length, video_length, tmp_dir):
-    xmp_content = f'''<x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="Adobe XMP Core 5.1.0">
+_XMP_TEMPLATE = b'''<x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="Adobe XMP Core 5.1.0">
  <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
   <rdf:Description rdf:about=""
     xmlns:GCamera="http://ns.google.com/photos/1.0/camera/"
@@ -25,13 +25,13 @@ def create_xmp_file(image_length, video_length, tmp_dir):
      <rdf:li rdf:parseType="Resource">
       <Item:Mime>image/jpeg</Item:Mime>
       <Item:Semantic>Primary</Item:Semantic>
-      <Item:Length>{image_length}</Item:Length>
+      <Item:Length>__IMAGE_LENGTH__</Item:Length>
       <Item:Padding>0</Item:Padding>
      </rdf:li>
      <rdf:li rdf:parseType="Resource">
       <Item:Mime>video/mp4</Item:Mime>
       <Item:Semantic>MotionPhoto</Item:Semantic>
-      <Item:Length>{video_length}</Item:Length>
+      <Item:Length>__VIDEO_LENGTH__</Item:Length>
       <Item:Padding>0</Item:Padding>
      </rdf:li>
     </rdf:Seq>
@@ -40,27 +40,11 @@ def create_xmp_file(image_length, video_length, tmp_dir):
  </rdf:RDF>
 </x:xmpmeta>'''
 
-    xmp_path = os.path.join(tmp_dir, "motion.xmp")
-    with open(xmp_path, "w", encoding="utf-8") as f:
-        f.write(xmp_content.strip())
-    return xmp_path
 
+@functools.lru_cache(maxsize=256, typed=True)
+def build_xmp_content(image_length, video_length):
+    return fill_template(_XMP_TEMPLATE, image_length=image_length, video_length=video_length)
 
-def apply_metadata(file_path, xmp_path, exiftool_path="exiftool"):
-    cmd = [
-        exiftool_path,
-        "-overwrite_original",
-        "-n",
-        f"-xmp<={xmp_path}",
-        file_path
-    ]
-    try:
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-        return True
-    except subprocess.CalledProcessError as e:
-        logging.error("ExifTool 写入失败！")
-        logging.error(f"错误输出: {e.stderr}")
-        raise
 
 def gen_motion_photo(photo_path, video_path, output_dir):
     abs_photo = os.path.abspath(photo_path)
@@ -69,45 +53,53 @@ def gen_motion_photo(photo_path, video_path, output_dir):
     output_path = os.path.abspath(os.path.join(output_dir, file_name))
     os.makedirs(output_dir, exist_ok=True)
 
-    if not os.path.exists(abs_video):
-        raise FileNotFoundError(f"找不到视频文件: {abs_video}")
-    video_size = os.path.getsize(abs_video)
-
-    # 使用临时目录处理，防止 ExifTool 扫描到已损坏的旧输出文件
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        tmp_photo = os.path.join(tmp_dir, "temp_image.jpg")
-        shutil.copy2(abs_photo, tmp_photo)
-
-        logging.info(f"第一步: 正在为纯净图片注入元数据...")
-
-        # 1. 第一次写入元数据：建立 XMP 结构
-        current_size = os.path.getsize(tmp_photo)
-        xmp_file = create_xmp_file(current_size, video_size, tmp_dir)
-        apply_metadata(tmp_photo, xmp_file)
-
-        # 2. 第二次写入元数据：修正因为 XMP 注入导致的文件大小偏移
-        # Google 相册要求 Offset 必须极其精确
-        final_image_size = os.path.getsize(tmp_photo)
-        xmp_file_final = create_xmp_file(final_image_size, video_size, tmp_dir)
-        apply_metadata(tmp_photo, xmp_file_final)
-
-        # 3. 将处理好的图片移动到最终输出位置
-        if os.path.exists(output_path):
-            os.remove(output_path)
-        shutil.move(tmp_photo, output_path)
-
-        final_offset = os.path.getsize(output_path)
-        logging.info(f"第二步: 元数据注入成功。图片偏移量: {final_offset} 字节")
+    try:
+        video_size = os.stat(abs_video).st_size
+    except FileNotFoundError:
+        raise FileNotFoundError(f"找不到视频文件: {abs_video}") from None
 
-    # 4. 追加视频二进制流
-    logging.info(f"第三步: 正在追加视频流...")
-    with open(abs_video, "rb") as f_src:
-        video_data = f_src.read()
+    logging.info(f"第一步: 正在为纯净图片注入元数据，并写入图片与视频流...")
 
-    with open(output_path, "ab") as f_dst:
-        f_dst.write(video_data)
+    # 预先求解 XMP 注入后的图片大小，带 XMP 的图片紧跟视频二进制流一次写出
+    # Google 相册要求 Offset 必须极其精确
+    final_offset = write_injected_jpeg(
+        abs_photo, output_path, lambda length: build_xmp_content(length, video_size),
+        trailer_paths=(abs_video,))
+    logging.info(f"第二步: 写入完成。图片偏移量: {final_offset} 字节")
 
     logging.info(f"✨ 全部完成！文件已生成: {output_path}")
+    return output_path
+
+
+def gen_motion_photos_batch(items, workers=None):
+    """
+    多进程批量生成 MotionPhoto，items 为 (photo_path, video_path, output_dir) 列表
+    瓶颈在磁盘 I/O，进程数默认不超过 4 个以免相互争抢带宽；单张失败不影响其余图片，返回成功生成的路径
+    """
+    if workers is None:
+        workers = min(os.cpu_count() or 1, 4)
+
+    # 不同目录下的同名图片会落到同一输出路径，并发写入时结果不确定，只保留第一个，其余跳过
+    unique_items = []
+    seen = set()
+    for item in items:
+        photo_path, _, output_dir = item
+        output_path = os.path.abspath(os.path.join(output_dir, os.path.basename(photo_path)))
+        if output_path in seen:
+            logging.error(f"失败: {photo_path}: 与前面的图片输出路径相同: {output_path}")
+            continue
+        seen.add(output_path)
+        unique_items.append(item)
+
+    done = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [(item, pool.submit(gen_motion_photo, *item)) for item in unique_items]
+        for (photo_path, _, _), future in futures:
+            try:
+                done.append(future.result())
+            except Exception as e:
+                logging.error(f"失败: {photo_path}: {e}")
+    return done
 
 if __name__ == "__main__":
     SOURCE_JPG = "res/IMG_0001.jpg"
@@ -1,51 +1,40 @@
 import os
-import subprocess
+import asyncio
+import functools
 import logging
-import tempfile
-import shutil
 
-logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+from JpegUtils import fill_template, is_jpeg, reject_duplicate_outputs, write_injected_jpeg
 
+logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 
-def create_ultrahdr_xmp(image_length, gainmap_length, params, tmp_dir):
-    """
-    生成符合 Adobe Gain Map 规范的 XMP
-    params 包含: gainMapMin, gainMapMax, gamma, hdrCapacityMin, hdrCapacityMax
-    """
-    # 提取参数
-    gm_min = params.get('gainMapMin', 0.0)
-    gm_max = params.get('gainMapMax', 1.0)
-    gamma = params.get('gamma', 1.0)
-    h_min = params.get('hdrCapacityMin', 0.0)
-    h_max = params.get('hdrCapacityMax', 2.0)
 
-    xmp_content = f'''<x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="Adobe XMP Core 5.1.0">
+_ULTRAHDR_XMP_TEMPLATE = b'''<x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="Adobe XMP Core 5.1.0">
  <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
   <rdf:Description rdf:about=""
     xmlns:GContainer="http://ns.google.com/photos/1.0/container/"
     xmlns:Item="http://ns.google.com/photos/1.0/container/item/"
     xmlns:hdrgm="http://ns.adobe.com/hdr-gain-map/1.0/">
    <hdrgm:Version>1.0</hdrgm:Version>
-   <hdrgm:GainMapMin>{gm_min}</hdrgm:GainMapMin>
-   <hdrgm:GainMapMax>{gm_max}</hdrgm:GainMapMax>
-   <hdrgm:Gamma>{gamma}</hdrgm:Gamma>
+   <hdrgm:GainMapMin>__GAIN_MAP_MIN__</hdrgm:GainMapMin>
+   <hdrgm:GainMapMax>__GAIN_MAP_MAX__</hdrgm:GainMapMax>
+   <hdrgm:Gamma>__GAMMA__</hdrgm:Gamma>
    <hdrgm:OffsetSDR>0.015625</hdrgm:OffsetSDR>
    <hdrgm:OffsetHDR>0.015625</hdrgm:OffsetHDR>
-   <hdrgm:HDRCapacityMin>{h_min}</hdrgm:HDRCapacityMin>
-   <hdrgm:HDRCapacityMax>{h_max}</hdrgm:HDRCapacityMax>
+   <hdrgm:HDRCapacityMin>__HDR_CAPACITY_MIN__</hdrgm:HDRCapacityMin>
+   <hdrgm:HDRCapacityMax>__HDR_CAPACITY_MAX__</hdrgm:HDRCapacityMax>
    <hdrgm:BaseRendition>SDR</hdrgm:BaseRendition>
    <GContainer:Directory>
     <rdf:Seq>
      <rdf:li rdf:parseType="Resource">
       <Item:Mime>image/jpeg</Item:Mime>
       <Item:Semantic>Primary</Item:Semantic>
-      <Item:Length>0</Item:Length>
+      <Item:Length>__IMAGE_LENGTH__</Item:Length>
       <Item:Padding>0</Item:Padding>
      </rdf:li>
      <rdf:li rdf:parseType="Resource">
       <Item:Mime>image/jpeg</Item:Mime>
       <Item:Semantic>GainMap</Item:Semantic>
-      <Item:Length>{gainmap_length}</Item:Length>
+      <Item:Length>__GAIN_MAP_LENGTH__</Item:Length>
       <Item:Padding>0</Item:Padding>
      </rdf:li>
     </rdf:Seq>
@@ -54,26 +43,47 @@ def create_ultrahdr_xmp(image_length, gainmap_length, params, tmp_dir):
  </rdf:RDF>
 </x:xmpmeta>'''
 
-    xmp_path = os.path.join(tmp_dir, "ultrahdr.xmp")
-    with open(xmp_path, "w", encoding="utf-8") as f:
-        f.write(xmp_content.strip())
-    return xmp_path
 
-
-def apply_ultrahdr_metadata(file_path, xmp_path):
+def build_ultrahdr_xmp_content(image_length, gainmap_length, params):
     """
-    使用 ExifTool 写入 XMP 并尝试构建 MPF 结构
+    生成符合 Adobe Gain Map 规范的 XMP
+    params 包含: gainMapMin, gainMapMax, gamma, hdrCapacityMin, hdrCapacityMax
     """
-    cmd = [
-        "exiftool",
-        "-overwrite_original",
-        f"-xmp<={xmp_path}",
-        # 这一行告诉查看器后面还有一个 MPF 图像对象
-        "-MPFVersion=0100",
-        "-NumberOfImages=2",
-        file_path
-    ]
-    subprocess.run(cmd, check=True, capture_output=True)
+    # 提取参数
+    gm_min = params.get('gainMapMin', 0.0)
+    gm_max = params.get('gainMapMax', 1.0)
+    gamma = params.get('gamma', 1.0)
+    h_min = params.get('hdrCapacityMin', 0.0)
+    h_max = params.get('hdrCapacityMax', 2.0)
+
+    return _build_ultrahdr_xmp(image_length, gainmap_length, gm_min, gm_max, gamma, h_min, h_max)
+
+
+# 批量处理时尺寸与参数相同的图片 XMP 完全一致，直接复用
+@functools.lru_cache(maxsize=256, typed=True)
+def _build_ultrahdr_xmp(image_length, gainmap_length, gm_min, gm_max, gamma, h_min, h_max):
+    return fill_template(
+        _ULTRAHDR_XMP_TEMPLATE,
+        gain_map_min=gm_min,
+        gain_map_max=gm_max,
+        gamma=gamma,
+        hdr_capacity_min=h_min,
+        hdr_capacity_max=h_max,
+        image_length=image_length,
+        gain_map_length=gainmap_length
+    )
+
+
+def _check_inputs(abs_sdr, abs_gm):
+    """检查文件合法性，返回 Gain Map 大小"""
+    for p in [abs_sdr, abs_gm]:
+        try:
+            valid = is_jpeg(p)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"找不到文件: {p}") from None
+        if not valid:
+            raise ValueError(f"文件不是有效的 JPEG: {p}")
+    return os.path.getsize(abs_gm)
 
 
 def gen_ultra_hdr(sdr_path, gainmap_path, output_path, params):
@@ -81,46 +91,46 @@ def gen_ultra_hdr(sdr_path, gainmap_path, output_path, params):
     abs_gm = os.path.abspath(gainmap_path)
 
     # 1. 检查文件合法性
-    for p in [abs_sdr, abs_gm]:
-        if not os.path.exists(p):
-            raise FileNotFoundError(f"找不到文件: {p}")
-        with open(p, 'rb') as f:
-            if f.read(2) != b'\xff\xd8':
-                raise ValueError(f"文件不是有效的 JPEG: {p}")
-
-    gm_size = os.path.getsize(abs_gm)
-
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        tmp_output = os.path.join(tmp_dir, "hdr_base.jpg")
-        shutil.copy2(abs_sdr, tmp_output)  # 这里 photo 指代你的 sdr_path
-
-        # 2. 处理元数据
-        logging.info("正在注入 Ultra HDR 元数据...")
-        # 第一次注入以确定大小
-        xmp_file = create_ultrahdr_xmp(0, gm_size, params, tmp_dir)
-        apply_ultrahdr_metadata(tmp_output, xmp_file)
-
-        # 修正真正的 Primary 长度（即包含所有元数据的 SDR 部分大小）
-        sdr_final_size = os.path.getsize(tmp_output)
-        xmp_file_final = create_ultrahdr_xmp(sdr_final_size, gm_size, params, tmp_dir)
-        apply_ultrahdr_metadata(tmp_output, xmp_file_final)
-
-        # 3. 最终移动
-        if os.path.exists(output_path):
-            os.remove(output_path)
-        shutil.move(tmp_output, output_path)
-
-    # 4. 追加 Gain Map 二进制流
-    logging.info(f"正在拼接 Gain Map (大小: {gm_size})...")
-    with open(abs_gm, "rb") as f_gm:
-        gm_data = f_gm.read()
-
-    with open(output_path, "ab") as f_dst:
-        f_dst.write(gm_data)
+    gm_size = _check_inputs(abs_sdr, abs_gm)
+
+    # 2. 处理元数据：XMP 与 MPF 都由我们直接生成，Primary 长度（即包含所有元数据的 SDR 部分大小）预先求解
+    # 3. 一次写出最终文件：带元数据的 SDR 紧跟 Gain Map 二进制流
+    logging.info(f"正在注入 Ultra HDR 元数据并拼接 Gain Map (大小: {gm_size})...")
+    write_injected_jpeg(
+        abs_sdr, output_path,
+        lambda length: build_ultrahdr_xmp_content(length, gm_size, params),
+        secondary_sizes=(gm_size,), trailer_paths=(abs_gm,)
+    )
 
     logging.info(f"✨ Ultra HDR 生成成功: {output_path}")
 
 
+async def gen_ultra_hdr_async(sdr_path, gainmap_path, output_path, params):
+    """gen_ultra_hdr 的协程版本，文件读写放到线程中执行，不阻塞事件循环"""
+    await asyncio.to_thread(gen_ultra_hdr, sdr_path, gainmap_path, output_path, params)
+
+
+async def gen_ultra_hdr_batch_async(items, params, concurrency=4):
+    """
+    并发批量生成 Ultra HDR，items 为 (sdr_path, gainmap_path, output_path) 列表
+    同时写入的图片不超过 concurrency 张，单张失败不影响其余图片，返回成功生成的路径
+    """
+    reject_duplicate_outputs(os.path.abspath(output_path) for _, _, output_path in items)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(sdr_path, gainmap_path, output_path):
+        async with semaphore:
+            try:
+                await gen_ultra_hdr_async(sdr_path, gainmap_path, output_path, params)
+                return output_path
+            except Exception as e:
+                logging.error(f"失败: {sdr_path}: {e}")
+                return None
+
+    results = await asyncio.gather(*(run(*item) for item in items))
+    return [path for path in results if path is not None]
+
+
 # --- 配置参数 ---
 if __name__ == "__main__":
     # 根据你的具体数据填写
@@ -0,0 +1,348 @@
+import ctypes
+import errno
+import os
+import struct
+import sys
+import uuid
+
+XMP_NAMESPACE = b'http://ns.adobe.com/xap/1.0/\x00'
+
+MPF_SIGNATURE = b'MPF\x00'
+
+# APP1 段固定开销：标记(2) + 长度字段(2) + XMP 命名空间
+APP1_XMP_OVERHEAD = 4 + len(XMP_NAMESPACE)
+
+# MP Index IFD 在 MP 头之后的布局：TIFF 头(8) + 条目数(2) + 3 个条目(12 * 3) + 下一个 IFD 偏移(4)
+_MP_INDEX_IFD_SIZE = 8 + 2 + 12 * 3 + 4
+_MP_ENTRY_SIZE = 16
+_MP_TYPE_PRIMARY = 0x030000
+
+# 内核拷贝不可用时，用户态 read/write 每次读取的块大小
+_COPY_CHUNK_SIZE = 1 << 20
+
+# 小于该大小的尾部数据（如增益图）不值得单独做一次预分配
+_PREALLOCATE_MIN_SIZE = 8 << 20
+
+
+def fill_template(template, **fields):
+    """把预编译 XMP 模板中 __NAME__ 形式的占位符替换为对应字段值"""
+    for name, value in fields.items():
+        template = template.replace(f'__{name.upper()}__'.encode(), str(value).encode())
+    return template
+
+
+def solve_primary_length(base_size, overhead):
+    """
+    不动点迭代求解 Primary 长度：final = base_size + overhead + len(str(final))
+    位数随 final 单调不减，最多迭代两次即可收敛
+    """
+    final = base_size + overhead
+    while True:
+        candidate = base_size + overhead + len(str(final))
+        if candidate == final:
+            return final
+        final = candidate
+
+
+def is_jpeg(path):
+    """只用一次 read 检查 SOI 标记，不创建 Python 缓冲文件对象"""
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        return os.read(fd, 2) == b'\xff\xd8'
+    finally:
+        os.close(fd)
+
+
+def iter_segments(f):
+    """
+    遍历 JPEG 头部的标记段，产出 (marker, offset, length)
+    offset 指向标记字节 0xFF，length 为段长度字段的值（含自身 2 字节），遇到 SOS 停止
+    标记前的 0xFF 填充字节会被跳过；遇到无法解析或越过文件末尾的段即停止，剩余部分由调用方原样保留
+    """
+    file_size = os.fstat(f.fileno()).st_size
+    f.seek(0)
+    if f.read(2) != b'\xff\xd8':
+        raise ValueError("文件不是有效的 JPEG")
+    offset = 2
+    while True:
+        f.seek(offset)
+        header = f.read(2)
+        # 规范允许标记前出现任意数量的 0xFF 填充字节
+        while header == b'\xff\xff':
+            offset += 1
+            header = header[1:] + f.read(1)
+        if len(header) < 2 or header[0] != 0xFF:
+            return
+        length_field = f.read(2)
+        if len(length_field) < 2:
+            return
+        marker = header[1]
+        length = struct.unpack('>H', length_field)[0]
+        if length < 2 or offset + 2 + length > file_size:
+            return
+        yield marker, offset, length
+        if marker == 0xDA:
+            return
+        offset += 2 + length
+
+
+def create_partial_file(output_path):
+    """
+    在输出目录下创建本次写入专用的临时文件并返回路径，完成后由调用方原子替换到 output_path
+    文件名唯一，并发任务写同一输出路径时互不覆盖，也不会动到用户已有的同名文件
+    与 mkstemp 不同，用 0o666 创建，最终文件的权限照常遵循 umask
+    """
+    directory, name = os.path.split(os.path.abspath(output_path))
+    while True:
+        partial_path = os.path.join(directory, f".{name}.{uuid.uuid4().hex[:8]}.partial")
+        try:
+            fd = os.open(partial_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            continue
+        os.close(fd)
+        return partial_path
+
+
+def reject_duplicate_outputs(output_paths):
+    """并发批量任务中若有多个任务写同一输出路径则抛出 ValueError"""
+    seen = set()
+    for path in output_paths:
+        if path in seen:
+            raise ValueError(f"多个任务的输出路径相同: {path}")
+        seen.add(path)
+
+
+def copy_range(out_fd, in_fd, offset, count):
+    """
+    把 [offset, offset + count) 区间拷贝到 out_fd 的当前位置，处理部分写入
+    依次尝试 copy_file_range（同一文件系统上可走 reflink/服务端拷贝）、sendfile，
+    都不可用时（macOS、Windows）退回用户态按块 read/write
+    """
+    use_copy_file_range = hasattr(os, 'copy_file_range')
+    use_sendfile = hasattr(os, 'sendfile')
+    while count > 0:
+        if use_copy_file_range:
+            try:
+                sent = os.copy_file_range(in_fd, out_fd, count, offset)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                use_copy_file_range = False
+                continue
+            if sent == 0:
+                # 部分文件系统（如 procfs、某些 FUSE）不报错而是直接返回 0，交给后续方式判断是否真的到了末尾
+                use_copy_file_range = False
+                continue
+        elif use_sendfile:
+            try:
+                sent = os.sendfile(out_fd, in_fd, offset, count)
+            except OSError as e:
+                # macOS 的 sendfile 只能写 socket，返回 ENOTSOCK
+                if e.errno not in (errno.ENOTSOCK, errno.EINVAL, errno.ENOSYS):
+                    raise
+                use_sendfile = False
+                continue
+            if sent == 0:
+                raise EOFError("源文件在拷贝过程中被截断")
+        else:
+            _copy_userspace(out_fd, in_fd, offset, count)
+            return
+        offset += sent
+        count -= sent
+
+
+def _copy_userspace(out_fd, in_fd, offset, count):
+    """按块 read/write 拷贝，供没有 copy_file_range/sendfile 的平台（如 Windows）使用"""
+    os.lseek(in_fd, offset, os.SEEK_SET)
+    while count > 0:
+        chunk = os.read(in_fd, min(count, _COPY_CHUNK_SIZE))
+        if not chunk:
+            raise EOFError("源文件在拷贝过程中被截断")
+        count -= len(chunk)
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(out_fd, view):]
+
+
+def _xmp_copy_plan(f, file_size, strip_mpf=False):
+    """
+    规划注入 XMP 时需要保留的源文件区间：
+    跳过已有的 XMP APP1 段（strip_mpf 时连同 MPF APP2 段），新段插在开头的 APP0(JFIF)/APP1(Exif) 之后
+    返回 (插入点之前的区间, 插入点之后的区间)
+    """
+    before, after = [], []
+    leading = True
+    end = 2
+    for marker, offset, length in iter_segments(f):
+        end = file_size if marker == 0xDA else offset + 2 + length
+        head = f.read(len(XMP_NAMESPACE)) if marker in (0xE1, 0xE2) else b''
+        if marker == 0xE1 and head == XMP_NAMESPACE:
+            continue
+        if strip_mpf and marker == 0xE2 and head.startswith(MPF_SIGNATURE):
+            continue
+        if marker not in (0xE0, 0xE1):
+            leading = False
+        ranges = before if leading else after
+        if ranges and ranges[-1][1] == offset:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((offset, end))
+    if end < file_size:
+        # 头部存在无法解析的标记，剩余部分原样保留
+        after.append((end, file_size))
+    return before, after
+
+
+def xmp_segment(xmp_bytes):
+    """构造完整的 XMP APP1 段"""
+    length = 2 + len(XMP_NAMESPACE) + len(xmp_bytes)
+    if length > 0xFFFF:
+        raise ValueError("XMP 超出单个 APP1 段的 64KB 上限")
+    return b'\xff\xe1' + struct.pack('>H', length) + XMP_NAMESPACE + xmp_bytes
+
+
+def mpf_segment_size(image_count):
+    """包含 image_count 个 MP Entry 的 MPF APP2 段总长度"""
+    return 4 + len(MPF_SIGNATURE) + _MP_INDEX_IFD_SIZE + _MP_ENTRY_SIZE * image_count
+
+
+def build_mpf_app2(primary_size, secondary_sizes, segment_offset):
+    """
+    直接构造 MPF APP2 段（MPFVersion、NumberOfImages、MPEntry），无需 ExifTool 扫描文件
+    primary_size 为主图（含本段）总长度，secondary_sizes 为紧随主图之后的各副图长度
+    segment_offset 为本段在文件中的起始位置；副图偏移按规范以 MP 头的字节序标记为基准
+    """
+    count = 1 + len(secondary_sizes)
+    header_pos = segment_offset + 4 + len(MPF_SIGNATURE)
+
+    entries = struct.pack('>IIIHH', _MP_TYPE_PRIMARY, primary_size, 0, 0, 0)
+    image_pos = primary_size
+    for size in secondary_sizes:
+        entries += struct.pack('>IIIHH', 0, size, image_pos - header_pos, 0, 0)
+        image_pos += size
+
+    ifd = struct.pack('>H', 3)
+    ifd += struct.pack('>HHI4s', 0xB000, 7, 4, b'0100')
+    ifd += struct.pack('>HHII', 0xB001, 4, 1, count)
+    ifd += struct.pack('>HHII', 0xB002, 7, _MP_ENTRY_SIZE * count, _MP_INDEX_IFD_SIZE)
+    ifd += struct.pack('>I', 0)
+
+    payload = MPF_SIGNATURE + b'MM\x00\x2a' + struct.pack('>I', 8) + ifd + entries
+    return b'\xff\xe2' + struct.pack('>H', 2 + len(payload)) + payload
+
+
+def stripped_jpeg_size(src_path, strip_mpf=False):
+    """源 JPEG 去掉已有 XMP 段（以及 MPF 段）后的大小，即注入新段前的基准长度"""
+    with open(src_path, 'rb') as f:
+        before, after = _xmp_copy_plan(f, os.fstat(f.fileno()).st_size, strip_mpf)
+    return 2 + sum(end - start for start, end in before + after)
+
+
+def inject_xmp_segment(src_path, dst_path, xmp_bytes, secondary_sizes=(), trailer_paths=()):
+    """
+    不经过 ExifTool，直接把 XMP 作为 APP1 段拼接进 JPEG，其余字节用 copy_range 原样拷贝
+    secondary_sizes 非空时（Ultra HDR 的增益图），在 XMP 之后紧跟一个 MPF APP2 段
+    trailer_paths 中的文件（视频、增益图）在同一次打开中紧接着写入
+    返回写出的 JPEG 部分长度
+    """
+    segment = xmp_segment(xmp_bytes)
+    with open(src_path, 'rb') as f_src, open(dst_path, 'wb', buffering=0) as f_dst:
+        before, after = _xmp_copy_plan(f_src, os.fstat(f_src.fileno()).st_size, bool(secondary_sizes))
+        before_size = sum(end - start for start, end in before)
+        after_size = sum(end - start for start, end in after)
+        if secondary_sizes:
+            primary_size = 2 + before_size + len(segment) + mpf_segment_size(1 + len(secondary_sizes)) + after_size
+            segment += build_mpf_app2(primary_size, secondary_sizes, 2 + before_size + len(segment))
+
+        advise_sequential(f_src.fileno())
+        f_dst.write(b'\xff\xd8')
+        for start, end in before:
+            copy_range(f_dst.fileno(), f_src.fileno(), start, end - start)
+        f_dst.write(segment)
+        for start, end in after:
+            copy_range(f_dst.fileno(), f_src.fileno(), start, end - start)
+        for trailer_path in trailer_paths:
+            copy_file(f_dst.fileno(), trailer_path)
+    return 2 + before_size + len(segment) + after_size
+
+
+def solve_injected_length(src_path, build_xmp, secondary_sizes=()):
+    """
+    预先求出注入 XMP（以及 MPF）后的 Primary 长度，并返回对应的 XMP 字节
+    build_xmp(length) 返回 XMP 字节，secondary_sizes 与 inject_xmp_segment 的参数一致
+    """
+    base_size = stripped_jpeg_size(src_path, bool(secondary_sizes))
+    overhead = len(build_xmp('')) + APP1_XMP_OVERHEAD
+    if secondary_sizes:
+        overhead += mpf_segment_size(1 + len(secondary_sizes))
+    final_size = solve_primary_length(base_size, overhead)
+    return final_size, build_xmp(final_size)
+
+
+def write_injected_jpeg(src_path, output_path, build_xmp, secondary_sizes=(), trailer_paths=()):
+    """
+    求解 Primary 长度、注入 XMP（以及 MPF）并拼接 trailer_paths，写入同目录的临时文件后原子替换到 output_path
+    源图片与输出路径相同时也不会被提前截断；任何失败都会删除临时文件
+    参数含义与 solve_injected_length / inject_xmp_segment 一致，返回 Primary 长度
+    """
+    partial_path = create_partial_file(output_path)
+    try:
+        primary_size, xmp_bytes = solve_injected_length(src_path, build_xmp, secondary_sizes)
+        written = inject_xmp_segment(src_path, partial_path, xmp_bytes, secondary_sizes, trailer_paths)
+        if written != primary_size:
+            raise RuntimeError(f"写出的图片长度 {written} 与 XMP 中记录的 {primary_size} 不一致")
+        os.replace(partial_path, output_path)
+    except BaseException:
+        try:
+            os.remove(partial_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return primary_size
+
+
+def advise_sequential(fd):
+    """提示内核按顺序读取，放大预读窗口；不支持 posix_fadvise 的平台直接跳过"""
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+
+def _load_fallocate():
+    """
+    取得 glibc 的 fallocate(2) 包装；posix_fallocate 在文件系统不支持时会逐块写零模拟，反而更慢
+    非 Linux 平台或找不到符号时返回 None
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        fallocate = ctypes.CDLL(None, use_errno=True).fallocate64
+    except (OSError, AttributeError):
+        return None
+    fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+    fallocate.restype = ctypes.c_int
+    return fallocate
+
+
+_fallocate = _load_fallocate()
+
+
+def preallocate(fd, offset, length):
+    """
+    预先为即将写入的大段区间分配连续空间，大文件追加时只产生一次分配事务
+    只调用 mode 为 0 的 fallocate(2)，文件系统不支持（ZFS、FUSE、NFSv3 等）时直接跳过，照常追加
+    """
+    if length < _PREALLOCATE_MIN_SIZE or _fallocate is None:
+        return
+    if _fallocate(fd, 0, offset, length) != 0:
+        err = ctypes.get_errno()
+        if err not in (errno.EOPNOTSUPP, errno.ENOSYS):
+            raise OSError(err, os.strerror(err))
+
+
+def copy_file(out_fd, src_path):
+    """把整个文件写到 out_fd 的当前位置，支持的平台上走内核拷贝，不在 Python 堆上缓存数据"""
+    with open(src_path, 'rb', buffering=0) as f_src:
+        size = os.fstat(f_src.fileno()).st_size
+        advise_sequential(f_src.fileno())
+        preallocate(out_fd, os.lseek(out_fd, 0, os.SEEK_CUR), size)
+        copy_range(out_fd, f_src.fileno(), 0, size)
@@ -1,22 +1,12 @@
 import os
-import subprocess
+import functools
 import logging
-import tempfile
-import shutil
 
-logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+from JpegUtils import fill_template, write_injected_jpeg
 
-def create_combined_xmp(sdr_len, gm_len, video_len, params, tmp_dir):
-    """
-    生成同时包含 GainMap 和 MotionPhoto 描述的 XMP
-    """
-    # HDR 参数
-    gm_min = params.get('gainMapMin', 0.0)
-    gm_max = params.get('gainMapMax', 2.1)
-    gamma = params.get('gamma', 1.0)
-    h_max = params.get('hdrCapacityMax', 2.1)
+logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 
-    xmp_content = f'''<x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="Adobe XMP Core 5.1.0">
+_COMBINED_XMP_TEMPLATE = b'''<x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="Adobe XMP Core 5.1.0">
  <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
   <rdf:Description rdf:about=""
     xmlns:GCamera="http://ns.google.com/photos/1.0/camera/"
@@ -26,68 +16,71 @@ def create_combined_xmp(sdr_len, gm_len, video_len, params, tmp_dir):
    <GCamera:MotionPhoto>1</GCamera:MotionPhoto>
    <GCamera:MotionPhotoVersion>1</GCamera:MotionPhotoVersion>
    <hdrgm:Version>1.0</hdrgm:Version>
-   <hdrgm:GainMapMin>{gm_min}</hdrgm:GainMapMin>
-   <hdrgm:GainMapMax>{gm_max}</hdrgm:GainMapMax>
-   <hdrgm:Gamma>{gamma}</hdrgm:Gamma>
-   <hdrgm:HDRCapacityMax>{h_max}</hdrgm:HDRCapacityMax>
+   <hdrgm:GainMapMin>__GAIN_MAP_MIN__</hdrgm:GainMapMin>
+   <hdrgm:GainMapMax>__GAIN_MAP_MAX__</hdrgm:GainMapMax>
+   <hdrgm:Gamma>__GAMMA__</hdrgm:Gamma>
+   <hdrgm:HDRCapacityMax>__HDR_CAPACITY_MAX__</hdrgm:HDRCapacityMax>
    <hdrgm:BaseRendition>SDR</hdrgm:BaseRendition>
    <GContainer:Directory>
     <rdf:Seq>
      <rdf:li rdf:parseType="Resource">
       <Item:Mime>image/jpeg</Item:Mime>
       <Item:Semantic>Primary</Item:Semantic>
-      <Item:Length>{sdr_len}</Item:Length>
+      <Item:Length>__SDR_LENGTH__</Item:Length>
      </rdf:li>
      <rdf:li rdf:parseType="Resource">
       <Item:Mime>image/jpeg</Item:Mime>
       <Item:Semantic>GainMap</Item:Semantic>
-      <Item:Length>{gm_len}</Item:Length>
+      <Item:Length>__GAIN_MAP_LENGTH__</Item:Length>
      </rdf:li>
      <rdf:li rdf:parseType="Resource">
       <Item:Mime>video/mp4</Item:Mime>
       <Item:Semantic>MotionPhoto</Item:Semantic>
-      <Item:Length>{video_len}</Item:Length>
+      <Item:Length>__VIDEO_LENGTH__</Item:Length>
      </rdf:li>
     </rdf:Seq>
    </GContainer:Directory>
   </rdf:Description>
  </rdf:RDF>
 </x:xmpmeta>'''
-    
-    xmp_path = os.path.join(tmp_dir, "combined.xmp")
-    with open(xmp_path, "w", encoding="utf-8") as f:
-        f.write(xmp_content.strip())
-    return xmp_path
 
-def apply_metadata(file_path, xmp_path):
-    cmd = ["exiftool", "-overwrite_original", "-n", f"-xmp<={xmp_path}", "-MPFVersion=0100", "-NumberOfImages=3", file_path]
-    subprocess.run(cmd, check=True, capture_output=True)
+def build_combined_xmp_content(sdr_len, gm_len, video_len, params):
+    """
+    生成同时包含 GainMap 和 MotionPhoto 描述的 XMP
+    """
+    # HDR 参数
+    gm_min = params.get('gainMapMin', 0.0)
+    gm_max = params.get('gainMapMax', 2.1)
+    gamma = params.get('gamma', 1.0)
+    h_max = params.get('hdrCapacityMax', 2.1)
+
+    return _build_combined_xmp(sdr_len, gm_len, video_len, gm_min, gm_max, gamma, h_max)
+
+# 批量处理时尺寸与参数相同的图片 XMP 完全一致，直接复用
+@functools.lru_cache(maxsize=256, typed=True)
+def _build_combined_xmp(sdr_len, gm_len, video_len, gm_min, gm_max, gamma, h_max):
+    return fill_template(
+        _COMBINED_XMP_TEMPLATE,
+        gain_map_min=gm_min,
+        gain_map_max=gm_max,
+        gamma=gamma,
+        hdr_capacity_max=h_max,
+        sdr_length=sdr_len,
+        gain_map_length=gm_len,
+        video_length=video_len
+    )
 
 def gen_hdr_motion_photo(sdr_path, gm_path, video_path, output_path, params):
     gm_size = os.path.getsize(gm_path)
     video_size = os.path.getsize(video_path)
 
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        tmp_jpg = os.path.join(tmp_dir, "base.jpg")
-        shutil.copy2(sdr_path, tmp_jpg)
-
-        logging.info("Step 1: 注入 HDR + Motion 联合元数据...")
-        # 第一次写入占位
-        xmp = create_combined_xmp(0, gm_size, video_size, params, tmp_dir)
-        apply_metadata(tmp_jpg, xmp)
-        
-        # 第二次写入精确长度
-        final_sdr_size = os.path.getsize(tmp_jpg)
-        xmp_final = create_combined_xmp(final_sdr_size, gm_size, video_size, params, tmp_dir)
-        apply_metadata(tmp_jpg, xmp_final)
-
-        if os.path.exists(output_path): os.remove(output_path)
-        shutil.move(tmp_jpg, output_path)
-
-    logging.info("Step 2: 正在物理拼接 GainMap 和 Video 流...")
-    with open(output_path, "ab") as f_dst:
-        with open(gm_path, "rb") as f_gm: f_dst.write(f_gm.read())
-        with open(video_path, "rb") as f_vid: f_dst.write(f_vid.read())
+    logging.info("Step 1: 生成 HDR + Motion 联合元数据，并物理拼接 GainMap 和 Video 流...")
+    # XMP 与 MPF 一次生成；MPF 只登记 JPEG 图像（主图与 GainMap），视频由 XMP 容器描述
+    write_injected_jpeg(
+        sdr_path, output_path,
+        lambda length: build_combined_xmp_content(length, gm_size, video_size, params),
+        secondary_sizes=(gm_size,), trailer_paths=(gm_path, video_path)
+    )
 
     logging.info(f"✨ 合成成功！{output_path}")
 